@@ -1,20 +1,49 @@
 import base64
+import html
 import json
 import os
 import re
+import time
+import warnings
+from concurrent.futures.thread import ThreadPoolExecutor
 from getpass import getpass
 from pprint import pprint
-from typing import Optional, TypedDict, Union
-from urllib.parse import urljoin
+from typing import Callable, Optional, TypedDict, Union
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from dotenv import load_dotenv
+from lxml import etree
+from lxml import html as lxhtml
+from requests.adapters import HTTPAdapter
 from rich.prompt import Prompt
 from rich.status import Status
+from urllib3.util import Retry
 
 BASE_URL = "https://www.gradescope.com"
 CSRF_TOKEN_HEADER = "X-Csrf-Token"
+# how long a csrf token fetched from a submissions page is reused for
+CSRF_CACHE_SECONDS = 600
+
+# patterns for pulling single attributes out of raw page content,
+# avoiding a full HTML parse when only a few values are needed
+_CSRF_TOKEN_RE = re.compile(rb'<meta[^>]+name="csrf-token"[^>]+content="([^"]+)"')
+_CSRF_PARAM_RE = re.compile(rb'<meta[^>]+name="csrf-param"[^>]+content="([^"]+)"')
+_PROPS_RE = re.compile(
+    rb'data-react-class="AssignmentSubmissionViewer"[^>]*data-react-props="([^"]*)"'
+)
+_ROSTER_RE = re.compile(rb"gon\.roster=(.*?);", re.DOTALL)
+# the login form's authenticity token, with attributes in either order
+_AUTH_TOKEN_RE = re.compile(rb'name="authenticity_token"\s+value="([^"]+)"')
+_AUTH_TOKEN_REVERSED_RE = re.compile(rb'value="([^"]+)"\s+name="authenticity_token"')
+
+# compiled lookups for the grades table on the "review grades" page
+_GRADES_TABLE_XPATH = etree.XPath(
+    "//table[contains(concat(' ', normalize-space(@class), ' '), ' js-reviewGradesTable ')]"
+)
+_GRADES_HEADER_XPATH = etree.XPath(".//thead//th")
+_GRADES_ROWS_XPATH = etree.XPath("./tbody/tr")
+_UTF8_HTML_PARSER = lxhtml.HTMLParser(encoding="utf-8")
 
 
 class GradeTableRow(TypedDict):
@@ -24,18 +53,80 @@ class GradeTableRow(TypedDict):
     submission: Optional[str]
 
 
+def _extract_csrf(content: bytes) -> Optional[tuple[str, str]]:
+    """
+    Extract the (csrf_field, csrf_token) pair from the <meta> tags in raw page content.
+
+    Returns None if either <meta> tag could not be found.
+    """
+    csrf_token_match = _CSRF_TOKEN_RE.search(content)
+    csrf_field_match = _CSRF_PARAM_RE.search(content)
+    if csrf_token_match is None or csrf_field_match is None:
+        return None
+    csrf_token = html.unescape(csrf_token_match.group(1).decode("utf-8"))
+    csrf_field = html.unescape(csrf_field_match.group(1).decode("utf-8"))
+    return csrf_field, csrf_token
+
+
+def _soup(
+    response: requests.Response, parse_only: Optional[SoupStrainer] = None
+) -> BeautifulSoup:
+    """
+    Parse the content of a response.
+
+    Gradescope serves pages as UTF-8, so the encoding is given explicitly
+    to skip character encoding detection.
+    """
+    return BeautifulSoup(
+        response.content, "lxml", parse_only=parse_only, from_encoding="utf-8"
+    )
+
+
 class GradescopeAPI:
     """
     Gradescope API wrapper.
     """
 
-    def __init__(self, cookie_file=None):
+    # instance shared by callers of `get_shared`
+    _shared: Optional["GradescopeAPI"] = None
+
+    # url templates, filled in with `str.format`
+    LOGIN_URL = BASE_URL + "/login"
+    SUBMISSIONS_URL = (
+        BASE_URL + "/courses/{course_id}/assignments/{assignment_id}/submissions"
+    )
+    GRADES_URL = (
+        BASE_URL + "/courses/{course_id}/assignments/{assignment_id}/review_grades"
+    )
+    SUBMISSION_URL = SUBMISSIONS_URL + "/{submission_id}"
+    REGRADE_URL = SUBMISSION_URL + "/regrade"
+
+    def __init__(self, cookie_file=None, pool_size: int = 10):
         # load environment variables
         load_dotenv()
 
         self.cookie_file = cookie_file
+        self.pool_size = pool_size
         # initialize requests session
         self.session = requests.Session()
+        # size the connection pool for the number of concurrent workers,
+        # so that connections are reused rather than discarded when the pool is full;
+        # also retry transient server errors with backoff
+        adapter = HTTPAdapter(
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                # return the last response once retries run out,
+                # so that the error handling below each request still applies
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("https://", adapter)
+
+        # cache of (course_id, assignment_id) -> (fetch time, (csrf_field, csrf_token))
+        self._csrf_cache: dict[tuple[int, int], tuple[float, tuple[str, str]]] = {}
 
         # login user; this will populate self.sesion with the correct cookies.
         self.login(
@@ -43,6 +134,50 @@ class GradescopeAPI:
             password=os.environ.get("GRADESCOPE_PASSWORD", None),
         )
 
+    @classmethod
+    def get_shared(cls, cookie_file=None, pool_size: int = 10) -> "GradescopeAPI":
+        """
+        Get the shared API instance, creating (and logging in) if it does not exist yet.
+
+        This allows several scripts run back-to-back in the same process
+        to reuse one logged-in session and its connection pool.
+        The arguments are only used when creating the instance;
+        a warning is issued if they differ from those of the existing instance.
+        """
+        if cls._shared is None:
+            cls._shared = cls(cookie_file=cookie_file, pool_size=pool_size)
+        elif (
+            cls._shared.cookie_file != cookie_file
+            or cls._shared.pool_size != pool_size
+        ):
+            warnings.warn(
+                "Reusing the shared GradescopeAPI instance "
+                f"(cookie_file={cls._shared.cookie_file!r}, pool_size={cls._shared.pool_size}), "
+                f"ignoring cookie_file={cookie_file!r}, pool_size={pool_size}"
+            )
+        return cls._shared
+
+    @classmethod
+    def has_shared(cls) -> bool:
+        """
+        Whether the shared API instance currently exists.
+        """
+        return cls._shared is not None
+
+    def close(self):
+        """
+        Close the underlying session and its connections.
+        """
+        self.session.close()
+        if GradescopeAPI._shared is self:
+            GradescopeAPI._shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def login(self, email: str, password: str):
         """
         Logs in a user with the given email and password.
@@ -52,7 +187,7 @@ class GradescopeAPI:
         This allows for the webdriver to be used in future actions,
         without needing to login through the frontend form.
         """
-        login_url = urljoin(BASE_URL, "/login")
+        login_url = self.LOGIN_URL
 
         if self.cookie_file is not None and os.path.isfile(self.cookie_file):
             status = Status(f"Restoring cookies from [green]{self.cookie_file}[/green]")
@@ -68,20 +203,17 @@ class GradescopeAPI:
 
             response = self.session.get(login_url, timeout=20)
             status.stop()
-            try:
-                json_response = json.loads(response.content)
+            # only parse json if the server says it sent json; otherwise use html
+            if "json" in response.headers.get("Content-Type", ""):
+                json_response = response.json()
                 # should give {"warning":"You must be logged out to access this page."}
-                if (
-                    json_response["warning"]
-                    == "You must be logged out to access this page."
+                if json_response.get("warning", "").startswith(
+                    "You must be logged out"
                 ):
                     # all good to go
                     return True
-            except json.JSONDecodeError:
-                # invalid json, so use html
-                pass
 
-            soup = BeautifulSoup(response.content, "html.parser")
+            soup = _soup(response)
             login_btn = soup.find("input", {"value": "Log In", "type": "submit"})
 
             if login_btn is None:
@@ -101,12 +233,18 @@ class GradescopeAPI:
         # visit login page
         response = self.session.get(login_url, timeout=20)
 
-        soup = BeautifulSoup(response.content, "html.parser")
-
         # get authenticity token from form
-        form = soup.find("form")
-        token_input = form.find("input", {"name": "authenticity_token"})
-        token = token_input.get("value")
+        token_match = _AUTH_TOKEN_RE.search(response.content)
+        if token_match is None:
+            token_match = _AUTH_TOKEN_REVERSED_RE.search(response.content)
+        if token_match is not None:
+            token = html.unescape(token_match.group(1).decode("ascii"))
+        else:
+            # fall back to parsing the page
+            soup = _soup(response)
+            form = soup.find("form")
+            token_input = form.find("input", {"name": "authenticity_token"})
+            token = token_input.get("value")
 
         # prepare payload and headers
         payload = {
@@ -131,11 +269,18 @@ class GradescopeAPI:
             raise RuntimeError(
                 f"Failed to log in; (status {response.status_code})\nReponse: {response.content}"
             )
-        # also check content
-        page = BeautifulSoup(response.content, "html.parser")
-        spans = page.select(".alert-error span")
-        if any("Invalid email/password combination" in span.text for span in spans):
-            raise RuntimeError("Failed to log in; invalid email/password combination.")
+        # a successful login redirects away from the login page;
+        # only check the content for errors if we ended up back on the login page
+        redirected = any(r.status_code in (301, 302) for r in response.history)
+        if not redirected or "/login" in response.url:
+            page = _soup(response)
+            spans = page.select(".alert-error span")
+            if any(
+                "Invalid email/password combination" in span.text for span in spans
+            ):
+                raise RuntimeError(
+                    "Failed to log in; invalid email/password combination."
+                )
 
         if self.cookie_file is not None:
             # save cookies as json
@@ -156,42 +301,64 @@ class GradescopeAPI:
             - roster data as a dict
             - tuple of (csrf_field, csrf_token) for the csrf token on the page
         """
-        submissions_url = urljoin(
-            BASE_URL, f"/courses/{course_id}/assignments/{assignment_id}/submissions"
+        response = self._get_submission_page(course_id, assignment_id)
+
+        # match and parse roster data directly from the page content
+        roster_data_match = _ROSTER_RE.search(response.content)
+        if roster_data_match is None:
+            raise RuntimeError("Failed to find roster data!")
+        roster_data = roster_data_match.group(1)
+
+        # get the csrf token
+        csrf_data = self._cache_csrf(course_id, assignment_id, response.content)
+
+        return json.loads(roster_data), csrf_data
+
+    def get_csrf(self, course_id: int, assignment_id: int) -> tuple[str, str]:
+        """
+        Get the (csrf_field, csrf_token) pair for an assignment submission page.
+
+        The result is cached for CSRF_CACHE_SECONDS; the page is only fetched
+        if there is no fresh cached token, and the roster data is not parsed.
+        """
+        cached = self._csrf_cache.get((int(course_id), int(assignment_id)))
+        if cached is not None:
+            fetch_time, csrf_data = cached
+            if time.monotonic() - fetch_time < CSRF_CACHE_SECONDS:
+                return csrf_data
+
+        response = self._get_submission_page(course_id, assignment_id)
+        return self._cache_csrf(course_id, assignment_id, response.content)
+
+    def _get_submission_page(
+        self, course_id: int, assignment_id: int
+    ) -> requests.Response:
+        """
+        Fetch an assignment submission page, raising an error on a bad response.
+        """
+        submissions_url = self.SUBMISSIONS_URL.format(
+            course_id=course_id, assignment_id=assignment_id
         )
         response = self.session.get(submissions_url)
         if not response.ok:
             raise RuntimeError(
                 f"Failed to fetch assignment page; (status {response.status_code})\nResponse: {response.content}"
             )
+        return response
 
-        # parse page content
-        page = BeautifulSoup(response.content, "html.parser")
-
-        # find the script tag with the roster data
-        scripts = page.select("script")
-        data_tag = None
-        for script_tag in scripts:
-            if re.search(r"<!\[CDATA\[", script_tag.text):
-                # script tag matches; exit loop
-                data_tag = script_tag
-                break
-        if data_tag is None:
-            raise RuntimeError("Failed to find roster data!")
-
-        # match and parse roster data
-        roster_data_match = re.search(r"gon\.roster=(.*?);", data_tag.text)
-        roster_data = roster_data_match.group(1)
-
-        # get the csrf token
-        csrf_token_meta = page.find("meta", {"name": "csrf-token"})
-        csrf_field_meta = page.find("meta", {"name": "csrf-param"})
-        assert csrf_token_meta is not None, "<meta> tag for csrf token not found"
-        assert csrf_field_meta is not None, "<meta> tag for csrf parameter not found"
-        csrf_token = csrf_token_meta["content"]
-        csrf_field = csrf_field_meta["content"]
-
-        return json.loads(roster_data), (csrf_field, csrf_token)
+    def _cache_csrf(
+        self, course_id: int, assignment_id: int, content: bytes
+    ) -> tuple[str, str]:
+        """
+        Extract the csrf token from a submission page and cache it.
+        """
+        csrf_data = _extract_csrf(content)
+        assert csrf_data is not None, "<meta> tags for csrf token not found"
+        self._csrf_cache[(int(course_id), int(assignment_id))] = (
+            time.monotonic(),
+            csrf_data,
+        )
+        return csrf_data
 
     def fetch_grades_data(
         self, course_id: int, assignment_id: int
@@ -199,29 +366,31 @@ class GradescopeAPI:
         """
         Fetch grade data on the "review grades" page.
         """
-        grades_url = urljoin(
-            BASE_URL, f"courses/{course_id}/assignments/{assignment_id}/review_grades"
+        grades_url = self.GRADES_URL.format(
+            course_id=course_id, assignment_id=assignment_id
         )
         response = self.session.get(grades_url)
 
-        page = BeautifulSoup(response.content, "html.parser")
+        page = lxhtml.fromstring(response.content, parser=_UTF8_HTML_PARSER)
 
-        grades_table = page.select_one("table.js-reviewGradesTable")
-        assert grades_table is not None, "Grade table not found"
+        grades_tables = _GRADES_TABLE_XPATH(page)
+        assert len(grades_tables) > 0, "Grade table not found"
+        grades_table = grades_tables[0]
 
         # get the header to see which indices we need to look at
-        table_header = grades_table.select("thead th")
+        table_header = _GRADES_HEADER_XPATH(grades_table)
 
         name_idx = -1
         email_idx = -1
         score_idx = -1
         # overwrite index values
         for col_idx, header_item in enumerate(table_header):
-            if "name" in header_item.text.lower():
+            header_text = header_item.text_content().strip().lower()
+            if "name" in header_text:
                 name_idx = col_idx
-            elif "email" in header_item.text.lower():
+            elif "email" in header_text:
                 email_idx = col_idx
-            elif "score" in header_item.text.lower():
+            elif "score" in header_text:
                 score_idx = col_idx
 
         if name_idx < 0 or email_idx < 0 or score_idx < 0:
@@ -231,14 +400,15 @@ class GradescopeAPI:
 
         # iterate through each row in the table, extracting the necessary information
         table_data = []
-        for table_row in grades_table.select("tbody tr"):
-            row_elements = table_row.select("td")
+        for table_row in _GRADES_ROWS_XPATH(grades_table):
+            row_elements = table_row.findall("td")
+            name_cell = row_elements[name_idx]
 
-            name = row_elements[name_idx].text
-            email = row_elements[email_idx].text
-            score = row_elements[score_idx].text
+            name = name_cell.text_content().strip()
+            email = row_elements[email_idx].text_content().strip()
+            score = row_elements[score_idx].text_content().strip()
 
-            submission_link_tag = row_elements[name_idx].select_one("a")
+            submission_link_tag = name_cell.find(".//a")
 
             if submission_link_tag is None:
                 # no submission for the student
@@ -262,30 +432,40 @@ class GradescopeAPI:
     def fetch_autograder_submission_status(
         self, course_id: int, assignment_id: int, submission_id: int
     ):
-        submission_url = urljoin(
-            BASE_URL,
-            f"courses/{course_id}/assignments/{assignment_id}/submissions/{submission_id}",
+        submission_url = self.SUBMISSION_URL.format(
+            course_id=course_id, assignment_id=assignment_id, submission_id=submission_id
         )
         response = self.session.get(submission_url)
 
-        page = BeautifulSoup(response.content, "html.parser")
-
-        # get the csrf token
-        csrf_token_meta = page.find("meta", {"name": "csrf-token"})
-        csrf_field_meta = page.find("meta", {"name": "csrf-param"})
-        assert csrf_token_meta is not None, "<meta> tag for csrf token not found"
-        assert csrf_field_meta is not None, "<meta> tag for csrf parameter not found"
-        csrf_token = csrf_token_meta.get("content")
-        csrf_field = csrf_field_meta.get("content")
-
-        submission_viewer = page.select_one(
-            'div[data-react-class="AssignmentSubmissionViewer"]'
-        )
-        assert submission_viewer is not None, "Cannot find submission viewer"
-        props_str = submission_viewer.get("data-react-props")
-        assert (
-            props_str is not None
-        ), "Submission viewer component doesn't have data-react-props attr"
+        # try to extract the needed values directly from the page content first
+        csrf_data = _extract_csrf(response.content)
+        props_match = _PROPS_RE.search(response.content)
+        if csrf_data is not None and props_match is not None:
+            csrf_field, csrf_token = csrf_data
+            props_str = html.unescape(props_match.group(1).decode("utf-8"))
+        else:
+            # fall back to parsing the page;
+            # only the <meta> tags and the submission viewer <div> are needed
+            page = _soup(response, parse_only=SoupStrainer(["meta", "div"]))
+
+            # get the csrf token
+            csrf_token_meta = page.find("meta", {"name": "csrf-token"})
+            csrf_field_meta = page.find("meta", {"name": "csrf-param"})
+            assert csrf_token_meta is not None, "<meta> tag for csrf token not found"
+            assert (
+                csrf_field_meta is not None
+            ), "<meta> tag for csrf parameter not found"
+            csrf_token = csrf_token_meta.get("content")
+            csrf_field = csrf_field_meta.get("content")
+
+            submission_viewer = page.select_one(
+                'div[data-react-class="AssignmentSubmissionViewer"]'
+            )
+            assert submission_viewer is not None, "Cannot find submission viewer"
+            props_str = submission_viewer.get("data-react-props")
+            assert (
+                props_str is not None
+            ), "Submission viewer component doesn't have data-react-props attr"
         props_json = json.loads(props_str)
 
         submission_metadata = props_json["assignment_submission"]
@@ -297,12 +477,52 @@ class GradescopeAPI:
             "csrf": (csrf_field, csrf_token),
         }
 
+    def batch_check(
+        self,
+        course_id: int,
+        assignment_id: int,
+        submission_ids: list[int],
+        max_workers: Optional[int] = None,
+        on_complete: Optional[Callable[[], None]] = None,
+    ) -> dict[int, dict]:
+        """
+        Fetch the autograder status of many submissions concurrently,
+        sharing this session's connection pool across all requests.
+
+        If max_workers is not given, it defaults to the size of the connection pool.
+        If on_complete is given, it is called after each status is fetched
+        (e.g. to advance a progress bar).
+
+        Returns a dict mapping each submission id to the output of
+        `fetch_autograder_submission_status` for that submission.
+        """
+        if max_workers is None:
+            max_workers = self.pool_size
+
+        # the requests are I/O bound, so threads are used rather than processes;
+        # this keeps a single session, which never needs to be pickled per task
+        with ThreadPoolExecutor(max_workers) as thread_pool:
+            futures = {}
+            for submission_id in submission_ids:
+                future = thread_pool.submit(
+                    self.fetch_autograder_submission_status,
+                    course_id,
+                    assignment_id,
+                    submission_id,
+                )
+                if on_complete is not None:
+                    future.add_done_callback(lambda _: on_complete())
+                futures[submission_id] = future
+            return {
+                submission_id: future.result()
+                for submission_id, future in futures.items()
+            }
+
     def autograder_regrade_submission(
         self, course_id: int, assignment_id: int, submission_id: int, csrf_token: str
     ) -> None:
-        regrade_url = urljoin(
-            BASE_URL,
-            f"courses/{course_id}/assignments/{assignment_id}/submissions/{submission_id}/regrade",
+        regrade_url = self.REGRADE_URL.format(
+            course_id=course_id, assignment_id=assignment_id, submission_id=submission_id
         )
         response = self.session.post(
             regrade_url, headers={CSRF_TOKEN_HEADER: csrf_token}
@@ -325,14 +545,12 @@ class GradescopeAPI:
         """
         Upload a file for a user in a given course and assignment.
         """
-        submissions_url = urljoin(
-            BASE_URL, f"/courses/{course_id}/assignments/{assignment_id}/submissions"
+        submissions_url = self.SUBMISSIONS_URL.format(
+            course_id=course_id, assignment_id=assignment_id
         )
 
         if csrf_data is None:
-            _, csrf_data = self.fetch_submission_page_data(
-                int(course_id), int(assignment_id)
-            )
+            csrf_data = self.get_csrf(int(course_id), int(assignment_id))
 
         csrf_field, csrf_token = csrf_data
 
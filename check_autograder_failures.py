@@ -1,40 +1,36 @@
 import re
 import time
+from concurrent.futures.thread import ThreadPoolExecutor
 
 from rich.console import Console
-from rich.progress import BarColumn, Progress, TimeElapsedColumn, track
+from rich.progress import BarColumn, Progress, TimeElapsedColumn
 
 from api.client import GradescopeAPI
 
 GRADESCOPE_BASEURL = "https://www.gradescope.com"
 AUTOGRADER_WAIT_SECONDS = 60
 
+_SUBMISSION_URL_RE = re.compile(
+    r"courses/(?P<course_id>\d+)/assignments/(?P<assignment_id>\d+)/submissions/(?P<submission_id>\d+)"
+)
+
 CONSOLE = Console(highlight=False)
 
 
-def validate_and_fix_submission(
-    api: GradescopeAPI,
-    course_id: int,
-    assignment_id: int,
-    submission_id: int,
+def validate_submission(
+    autograder_output: dict,
     # for logging purposes
     name: str,
     email: str,
-    # options
-    dry_run=False,
 ) -> bool:
     """
-    Fetch a submission's status, and if the autograder failed,
-    submit a POST request to regrade it.
+    Check a submission's autograder status, as fetched from the API.
 
     Returns whether the submission validated.
-      - If False, either a request was sent to regrade the submission, or the submission was not finished processing.
-      - If True, no further actions were taken, and the submission is validated.
+      - If False, the autograder failed or the submission was not finished processing,
+        and the submission should be regraded.
+      - If True, the submission is validated, and no further actions are needed.
     """
-    autograder_output = api.fetch_autograder_submission_status(
-        course_id, assignment_id, submission_id
-    )
-
     metadata = autograder_output["metadata"]
 
     if metadata["status"] == "processed":
@@ -48,99 +44,132 @@ def validate_and_fix_submission(
         # be conservative and still regrade
         CONSOLE.print(f"[violet]{metadata['status']}: {name} ({email})[/violet]")
 
-    if dry_run:
-        CONSOLE.print(
-            "\t[italic red]Dry run: Submission would be regraded[/italic red]"
-        )
-    else:
-        CONSOLE.print("\t[italic red]Regrading submission...[/italic red]")
-
-        (_, csrf_token) = autograder_output["csrf"]
-
-        api.autograder_regrade_submission(
-            course_id, assignment_id, submission_id, csrf_token
-        )
-
     return False
 
 
-def main(course_id: int, assignment_id: int, cookie_file="cookies.json", dry_run=False):
+def main(
+    course_id: int,
+    assignment_id: int,
+    cookie_file="cookies.json",
+    dry_run=False,
+    max_workers: int = 8,
+):
     if dry_run:
         CONSOLE.print("[green]DRY RUN - NO REGRADES WILL BE SENT[/green]")
-    api = GradescopeAPI(cookie_file=cookie_file)
-
-    grade_data = api.fetch_grades_data(course_id, assignment_id)
-
-    # filter only for submissions that got 0's
-    zero_scores = [
-        row for row in grade_data if row["score"] is not None and row["score"] == 0
-    ]
-
-    submissions_to_validate = []
-
-    i = 0
-    for table_row in zero_scores:
-        i += 1
-        if table_row["submission"] is None:
-            # no submission associated
-            continue
-
-        match = re.search(
-            r"courses/(?P<course_id>\d+)/assignments/(?P<assignment_id>\d+)/submissions/(?P<submission_id>\d+)",
-            table_row["submission"],
-        )
-        assert match is not None, "submission URL is not of the expected format"
-        submission_id = match.group("submission_id")
-        assert submission_id is not None, "Failed to extract submission id from URL"
-        submission_id = int(submission_id)
-
-        submissions_to_validate.append(
-            (submission_id, table_row["name"], table_row["email"])
-        )
-
-    while len(submissions_to_validate) > 0:
-        next_submissions_to_validate = []
-        for submission_data in track(
-            submissions_to_validate,
-            description="Validating submissions...",
-            transient=True,
-            console=CONSOLE,
-        ):
-            submission_id, name, email = submission_data
-            validated = validate_and_fix_submission(
-                api,
-                course_id,
-                assignment_id,
-                submission_id,
-                name,
-                email,
-                dry_run=dry_run,
+    # only close the session at the end if this call created the shared instance
+    owns_api = not GradescopeAPI.has_shared()
+    api = GradescopeAPI.get_shared(cookie_file=cookie_file, pool_size=max_workers)
+
+    try:
+        grade_data = api.fetch_grades_data(course_id, assignment_id)
+
+        # filter only for submissions that got 0's
+        zero_scores = [
+            row for row in grade_data if row["score"] is not None and row["score"] == 0
+        ]
+
+        submissions_to_validate = []
+
+        i = 0
+        for table_row in zero_scores:
+            i += 1
+            if table_row["submission"] is None:
+                # no submission associated
+                continue
+
+            try:
+                # submission URLs end in /submissions/<submission_id>
+                submission_id = int(
+                    table_row["submission"].rstrip("/").rsplit("/", 1)[-1]
+                )
+            except ValueError:
+                # fall back to matching the full URL
+                match = _SUBMISSION_URL_RE.search(table_row["submission"])
+                assert match is not None, "submission URL is not of the expected format"
+                submission_id = match.group("submission_id")
+                assert (
+                    submission_id is not None
+                ), "Failed to extract submission id from URL"
+                submission_id = int(submission_id)
+
+            submissions_to_validate.append(
+                (submission_id, table_row["name"], table_row["email"])
             )
 
-            if not validated:
-                next_submissions_to_validate.append(submission_data)
-
-        submissions_to_validate = next_submissions_to_validate
-        if len(submissions_to_validate) > 0 and not dry_run:
-            with Progress(
-                # columns
-                "[progress.description]{task.description}",
-                BarColumn(),
-                TimeElapsedColumn(),
-                # options
-                console=CONSOLE,
-            ) as progress:
-                timer_task = progress.add_task(
-                    "[yellow]Waiting 1 minute for submissions to regrade...[/yellow]",
-                    total=AUTOGRADER_WAIT_SECONDS,
+        while len(submissions_to_validate) > 0:
+            # fetch the status of every submission first
+            with Progress(transient=True, console=CONSOLE) as progress:
+                validate_task = progress.add_task(
+                    "Validating submissions...", total=len(submissions_to_validate)
+                )
+                autograder_outputs = api.batch_check(
+                    course_id,
+                    assignment_id,
+                    [submission_id for submission_id, _, _ in submissions_to_validate],
+                    max_workers=max_workers,
+                    on_complete=lambda: progress.advance(validate_task),
                 )
-                for _ in range(AUTOGRADER_WAIT_SECONDS):
-                    time.sleep(1)
-                    progress.advance(timer_task)
 
-        if dry_run:
-            # don't loop if we're doing a dry run
-            break
+            next_submissions_to_validate = []
+            regrade_args = []
+            for submission_data in submissions_to_validate:
+                submission_id, name, email = submission_data
+                autograder_output = autograder_outputs[submission_id]
+                if validate_submission(autograder_output, name, email):
+                    continue
+
+                next_submissions_to_validate.append(submission_data)
+                if dry_run:
+                    CONSOLE.print(
+                        "\t[italic red]Dry run: Submission would be regraded[/italic red]"
+                    )
+                else:
+                    CONSOLE.print(
+                        "\t[italic red]Submission will be regraded[/italic red]"
+                    )
+                    (_, csrf_token) = autograder_output["csrf"]
+                    regrade_args.append((submission_id, csrf_token))
+
+            # then send all of the regrade requests
+            if len(regrade_args) > 0:
+                with CONSOLE.status(
+                    f"[italic red]Regrading {len(regrade_args)} submissions...[/italic red]"
+                ), ThreadPoolExecutor(max_workers) as thread_pool:
+                    # consume the results to propagate any errors
+                    list(
+                        thread_pool.map(
+                            lambda args: api.autograder_regrade_submission(
+                                course_id, assignment_id, *args
+                            ),
+                            regrade_args,
+                        )
+                    )
+
+            submissions_to_validate = next_submissions_to_validate
+            if len(submissions_to_validate) > 0 and not dry_run:
+                with Progress(
+                    # columns
+                    "[progress.description]{task.description}",
+                    BarColumn(),
+                    TimeElapsedColumn(),
+                    # options
+                    console=CONSOLE,
+                    refresh_per_second=1,
+                ) as progress:
+                    # the elapsed time is redrawn by the progress display's own
+                    # refresh thread, so the main thread only needs to sleep once
+                    progress.add_task(
+                        "[yellow]Waiting 1 minute for submissions to regrade...[/yellow]",
+                        total=None,
+                    )
+                    time.sleep(AUTOGRADER_WAIT_SECONDS)
+
+            if dry_run:
+                # don't loop if we're doing a dry run
+                break
+    finally:
+        if owns_api:
+            api.close()
 
 
 if __name__ == "__main__":
@@ -161,6 +190,18 @@ if __name__ == "__main__":
         help="Dry run; does not submit any requests to regrade submissions, and only prints out the submissions that would be regraded",
         action="store_true",
     )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=8,
+        help="Maximum number of threads to use for validation requests.",
+    )
 
     args = parser.parse_args()
-    main(args.course_id, args.assignment_id, dry_run=args.dry_run)
+    main(
+        args.course_id,
+        args.assignment_id,
+        cookie_file=args.cookies,
+        dry_run=args.dry_run,
+        max_workers=args.threads,
+    )
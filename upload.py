@@ -2,10 +2,10 @@
 Bulk upload student submissions for a Gradescope assignment.
 """
 
-from concurrent.futures import as_completed
-from concurrent.futures.thread import ThreadPoolExecutor
+import asyncio
 from typing import Union
 
+import aiohttp
 from rich.console import Console
 from rich.progress import Progress
 
@@ -14,6 +14,87 @@ from api.client import GradescopeAPI
 CONSOLE = Console(highlight=False)
 
 
+async def upload_async(
+    session: aiohttp.ClientSession,
+    course_id: Union[str, int],
+    assignment_id: Union[str, int],
+    user_id: Union[str, int],
+    csrf_data: tuple[str, str],
+    filename: str = "upload.txt",
+    file_content: str = "",
+):
+    """
+    Upload a file for a user in a given course and assignment,
+    through an (already authenticated) aiohttp session.
+    """
+    submissions_url = GradescopeAPI.SUBMISSIONS_URL.format(
+        course_id=course_id, assignment_id=assignment_id
+    )
+
+    csrf_field, csrf_token = csrf_data
+
+    data = aiohttp.FormData()
+    data.add_field(csrf_field, csrf_token)
+    data.add_field("submission[owner_id]", str(user_id))
+    data.add_field("submission[method]", "upload")
+    data.add_field("submission[files][]", file_content, filename=filename)
+
+    async with session.post(submissions_url, data=data) as response:
+        if not response.ok:
+            content = await response.read()
+            raise RuntimeError(
+                f"Failed to upload file; (status {response.status})\n"
+                f"Response: {content}"
+            )
+    return True
+
+
+async def upload_all_async(
+    api: GradescopeAPI,
+    course_id: Union[str, int],
+    assignment_id: Union[str, int],
+    roster_data: list[dict],
+    csrf_data: tuple[str, str],
+    max_workers: int = 8,
+):
+    """
+    Upload a file for every user in the roster concurrently,
+    reusing the cookies from the given API session.
+    """
+    # the connector limit bounds the number of concurrent connections
+    connector = aiohttp.TCPConnector(limit=max_workers)
+    async with aiohttp.ClientSession(
+        connector=connector, cookies=api.session.cookies.get_dict()
+    ) as session:
+        with Progress(transient=True, console=CONSOLE) as progress:
+            upload_task = progress.add_task(
+                "Uploading files...", total=len(roster_data)
+            )
+            tasks = [
+                asyncio.create_task(
+                    upload_async(
+                        session, course_id, assignment_id, user["id"], csrf_data
+                    )
+                )
+                for user in roster_data
+            ]
+            for task in tasks:
+                task.add_done_callback(lambda _: progress.advance(upload_task))
+            # attempt every upload, even if some of them fail
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    failed_user_ids = []
+    for user, result in zip(roster_data, results):
+        if isinstance(result, Exception):
+            CONSOLE.print(f"[red]Upload failed for user {user['id']}: {result}[/red]")
+            failed_user_ids.append(user["id"])
+
+    if len(failed_user_ids) > 0:
+        raise RuntimeError(
+            f"Failed to upload files for {len(failed_user_ids)} users: {failed_user_ids}"
+        )
+
+
 def main(
     course_id: Union[str, int],
     assignment_id: Union[str, int],
@@ -22,43 +103,43 @@ def main(
     cookie_file="cookies.json",
     max_workers: int = 8,
 ):
-    api = GradescopeAPI(cookie_file=cookie_file)
-
-    roster_data, csrf_data = api.fetch_submission_page_data(course_id, assignment_id)
-    max_workers = 8
-
-    if upload_all:
-        with Progress(transient=True, console=CONSOLE) as progress, ThreadPoolExecutor(
-            max_workers
-        ) as thread_pool:
-            futures = [
-                thread_pool.submit(
-                    api.upload,
+    # only close the session at the end if this call created the shared instance
+    owns_api = not GradescopeAPI.has_shared()
+    api = GradescopeAPI.get_shared(cookie_file=cookie_file, pool_size=max_workers)
+
+    try:
+        roster_data, csrf_data = api.fetch_submission_page_data(
+            course_id, assignment_id
+        )
+
+        if upload_all:
+            # deduplicate users by id, in case the roster lists anyone more than once
+            unique_roster_data = list(
+                {user["id"]: user for user in roster_data}.values()
+            )
+            asyncio.run(
+                upload_all_async(
+                    api,
                     course_id,
                     assignment_id,
-                    user["id"],
-                    csrf_data=csrf_data,
+                    unique_roster_data,
+                    csrf_data,
+                    max_workers,
                 )
-                for user in roster_data
-            ]
-            upload_task = progress.add_task(
-                "Uploading files...", total=len(roster_data)
             )
-            for future in as_completed(futures):
-                progress.advance(upload_task)
-    elif user_email is not None:
-        # find the corresponding user id
-        user_id = None
-        for user in roster_data:
-            if user["email"] == user_email:
-                user_id = user["id"]
-                break
+        elif user_email is not None:
+            # find the corresponding user id
+            email_to_id = {user["email"]: user["id"] for user in roster_data}
+            user_id = email_to_id.get(user_email)
 
-        if user_id is None:
-            raise RuntimeError("Failed to find user email in the roster!")
+            if user_id is None:
+                raise RuntimeError("Failed to find user email in the roster!")
 
-        # upload file
-        api.upload(course_id, assignment_id, user_id, csrf_data=csrf_data)
+            # upload file
+            api.upload(course_id, assignment_id, user_id, csrf_data=csrf_data)
+    finally:
+        if owns_api:
+            api.close()
 
 
 if __name__ == "__main__":
@@ -82,7 +163,7 @@ if __name__ == "__main__":
         "--threads",
         type=int,
         default=8,
-        help="Maximum number of threads to use for upload requests.",
+        help="Maximum number of concurrent connections to use for upload requests.",
     )
 
     args = parser.parse_args()